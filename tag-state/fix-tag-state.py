@@ -1,70 +1,92 @@
 #!/usr/bin/env python
 import argparse
-from collections.abc import Iterable
+from collections.abc import Iterable, Iterator
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import functools
 import json
-import operator
 import os
 from pathlib import Path
-import re
 import signal
 import sys
 import subprocess
+import threading
+
+# ijson lets us parse the buildlog incrementally and orjson speeds up printing, but the script still works without them
+try:
+    import ijson
+except ImportError:
+    ijson = None
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 # requires docker be available on the CLI
 
 # constants
-SPLIT_VERSION_REGEX = re.compile("[.+-]")
 NEEDS_MANIFEST = "NEEDS_MANIFEST"
 PENDING = "PENDING"
 SUCCESS = "SUCCESS"
 FAILED = "FAILED"
+MAX_DOCKER_WORKERS = 8
+
+# set on Ctrl+C so docker commands already handed to worker threads don't start anything new
+interrupted = threading.Event()
+
+
+# splits a version on ".", "+", and "-". Chained str methods are cheaper than a regex on strings this short.
+def _split_version(s: str) -> list[str]:
+    return s.replace("+", "-").replace(".", "-").split("-")
 
 
 # distutils.version.LooseVersion is deprecated. packaging.version is the recommended replacement but I'd like to
 # keep this script vanilla. This is an attempt at re-implementation good enough for our purposes.
 class LooseVersion:
     def __init__(self, s):
-        self.vs = SPLIT_VERSION_REGEX.split(s)
-        self.n = max(len(x) for x in self.vs)
-
-    def cmp(self, other, op):
-        n = max(self.n, other.n)
-        return op(
-            tuple(x.zfill(n) for x in self.vs), tuple(x.zfill(n) for x in other.vs)
-        )
+        # computed once so comparisons are plain tuple compares. Numeric parts sort before alphanumeric ones.
+        parts = s.split(".")
+        if s.replace(".", "").isdigit() and "" not in parts:
+            # nearly every tag is plain M, M.N, or M.N.P, which doesn't need the general split or per part checks. The key
+            # keeps the same shape as the general case so the two stay comparable.
+            self.key = tuple((0, int(x)) for x in parts)
+        else:
+            self.key = tuple(
+                (0, int(x)) if x.isdigit() else (1, x) for x in _split_version(s)
+            )
 
     def __lt__(self, other):
-        return self.cmp(other, operator.lt)
+        return self.key < other.key
 
     def __le__(self, other):
-        return self.cmp(other, operator.le)
+        return self.key <= other.key
 
     def __gt__(self, other):
-        return self.cmp(other, operator.gt)
+        return self.key > other.key
 
     def __ge__(self, other):
-        return self.cmp(other, operator.ge)
+        return self.key >= other.key
 
     def __eq__(self, other):
-        return self.cmp(other, operator.eq)
+        return self.key == other.key
 
     def __ne__(self, other):
-        return self.cmp(other, operator.ne)
+        return self.key != other.key
+
+
+# the same version strings get compared over and over, so share their parsed keys
+_loose = functools.lru_cache(maxsize=None)(LooseVersion)
 
 
 def signal_handler(sig, frame):
     print_error("Exiting due to Ctrl+C")
-    sys.exit(0)
+    interrupted.set()
+    sys.exit(130)
 
 
 def print_error(*args, **kwargs):
     print(*args, file=sys.stderr, **kwargs)
 
 
-def pad_none(iterable: Iterable, length: int, padding=None) -> Iterable:
-    return iterable + [None] * (length - len(iterable))
-
-
 def create_script_arg_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser(
         description="""Script that reconstructs tag state from buildlog records. Depends on buildlog staying ordered by
@@ -79,76 +101,123 @@ def create_script_arg_parser() -> argparse.ArgumentParser:
     return parser
 
 
-def read_buildlog_file(buildlog_file_path: Path) -> dict:
+def read_buildlog_file(buildlog_file_path: Path) -> Iterator[dict]:
     if os.path.exists(buildlog_file_path):
-        with open(buildlog_file_path) as buildlog:
-            buildlog_data = json.loads(buildlog.read())
-            buildlog.close()
-            return buildlog_data
+        with open(buildlog_file_path, "rb") as buildlog:
+            # stream entries one at a time so tag state construction can start before the whole file is parsed. Without
+            # ijson the whole file has to be parsed up front, which orjson does much faster than json.
+            if ijson:
+                yield from ijson.items(buildlog, "item")
+            elif orjson:
+                yield from orjson.loads(buildlog.read())
+            else:
+                yield from json.load(buildlog)
     else:
-        print_error(f"Buildlog not found at {parsed_args.buildlog_file_path}")
+        # runs on the first iteration, before anything has been printed or pushed
+        print_error(f"Buildlog not found at {buildlog_file_path}")
+        sys.exit(1)
 
 
 def semver_sorted_dict(d: dict) -> dict:
-    return dict(sorted(d.items(), key=lambda i: LooseVersion(i[0])))
+    return dict(sorted(d.items(), key=lambda i: _loose(i[0]).key))
+
+
+# splits a buildlog version into (major, minor, patch, arch, medium_tag, manifest_semver), raising ValueError for
+# pre-releases. Rebuilds replay the same version many times so the result is cached.
+@functools.lru_cache(maxsize=None)
+def _parse_version(version: str) -> tuple[str, str, str, str | None, str, str]:
+    parts = _split_version(version)
+    if len(parts) > 4:
+        raise ValueError(f"Unexpected version format {version}")
+    major, minor, patch, arch = (*parts, None, None, None)[:4]
+    return major, minor, patch, arch, f"{major}.{minor}", f"{major}.{minor}.{patch}"
 
 
-def build_tag_state(buildlog_data: list) -> dict:
-    tag_state = {}
+# tag state is kept as two parallel dicts keyed by tag, one of digests and one of statuses
+def build_tag_state(buildlog_data: Iterable[dict]) -> tuple[dict, dict]:
+    digests = {}
+    # the full version each major/minor tag currently points at, and the reverse index of major/minor tags pointing at
+    # each full version (dicts rather than sets to keep tag order stable). Comparing digests instead can't tell apart two
+    # versions that both need a manifest, or two versions that were built from the same image.
+    followed_semver = {}
+    floating_tags_by_semver = {}
+    prev_version, prev_digest = None, None
     for buildlog_entry in buildlog_data:
         if "container_hash" in buildlog_entry and "version" in buildlog_entry:
             version = buildlog_entry["version"]
             digest = buildlog_entry["container_hash"]
+            # a repeat of the entry we just applied can't change anything
+            if version == prev_version and digest == prev_digest:
+                continue
+            prev_version, prev_digest = version, digest
             try:
-                major, minor, patch, arch = pad_none(
-                    version.replace(".", "-").split("-"), 4
+                major, minor, patch, arch, medium_tag, manifest_semver = _parse_version(
+                    version
                 )
-            except:
+            # non-string versions fail to split or hash, skip those the same way
+            except (ValueError, AttributeError, TypeError):
                 print_error(f"Skipping pre-release tag {version}")
                 continue
-            manifest_semver = f"{major}.{minor}.{patch}"
-            medium_tag = f"{major}.{minor}"
             if arch:
-                tag_state[version] = {"digest": digest, "status": PENDING}
-                tag_state[major] = {"digest": NEEDS_MANIFEST, "status": PENDING}
-                tag_state[medium_tag] = {
-                    "digest": NEEDS_MANIFEST,
-                    "status": PENDING,
-                }
-                tag_state[manifest_semver] = {
-                    "digest": NEEDS_MANIFEST,
-                    "status": PENDING,
-                }
-            else:
-                if manifest_semver in tag_state:
-                    # if the current digest for our major or minor tag is the previous version of this container, update it
-                    if (
-                        tag_state[major]["digest"]
-                        is tag_state[manifest_semver]["digest"]
-                    ):
-                        tag_state[major]["digest"] = digest
-                    if (
-                        tag_state[medium_tag]["digest"]
-                        is tag_state[manifest_semver]["digest"]
-                    ):
-                        tag_state[medium_tag]["digest"] = digest
-                    # update the full tag to the new version of the container always
-                    tag_state[manifest_semver] = {"digest": digest, "status": PENDING}
-                else:
-                    tag_state[major] = {"digest": digest, "status": PENDING}
-                    tag_state[medium_tag] = {
-                        "digest": digest,
-                        "status": PENDING,
-                    }
-                    tag_state[manifest_semver] = {"digest": digest, "status": PENDING}
+                digests[version] = digest
+                # the full tag will point at a manifest of all the arch images
+                digest = NEEDS_MANIFEST
+            # any major or minor tag pointing at the previous version of this container moves to the new one
+            floating_tags = floating_tags_by_semver.get(manifest_semver)
+            if floating_tags is None:
+                # a version we haven't seen before takes over its major and minor tags
+                floating_tags = floating_tags_by_semver[manifest_semver] = {}
+                for tag in (major, medium_tag):
+                    if tag in followed_semver:
+                        del floating_tags_by_semver[followed_semver[tag]][tag]
+                    followed_semver[tag] = manifest_semver
+                    floating_tags[tag] = None
+            for tag in floating_tags:
+                digests[tag] = digest
+            # update the full tag to the new version of the container always
+            digests[manifest_semver] = digest
         else:
             print_error(
                 f"Buildlog entry found without associated container hash: {buildlog_entry}"
             )
-    return semver_sorted_dict(tag_state)
+    return digests, dict.fromkeys(digests, PENDING)
+
+
+def run_quietly(command: list[str]) -> bool:
+    # output is captured so concurrent docker commands don't interleave, and only shown when something goes wrong
+    if interrupted.is_set():
+        return False
+    result = subprocess.run(command, capture_output=True, text=True)
+    if result.returncode != 0:
+        print_error(f"{' '.join(command)} failed:\n{result.stderr}")
+    return result.returncode == 0
+
+
+def pull_image(image_name_by_digest: str) -> bool:
+    # skip the registry round trip if a previous run already left the image in the local daemon
+    inspect = subprocess.run(
+        ["docker", "image", "inspect", "--format={{.Id}}", image_name_by_digest],
+        capture_output=True,
+    )
+    if inspect.returncode == 0:
+        return True
+    return run_quietly(["docker", "image", "pull", image_name_by_digest])
+
+
+def tag_and_push_image(image_name_by_digest: str, tagged_image_name: str) -> bool:
+    return run_quietly(
+        ["docker", "image", "tag", image_name_by_digest, tagged_image_name]
+    ) and run_quietly(["docker", "push", tagged_image_name])
 
 
 def pretty_printable_dict(d: dict) -> str:
+    if orjson:
+        # orjson only indents by 2, widen it so output looks the same either way. Everything we print is a flat dict.
+        return (
+            orjson.dumps(d, option=orjson.OPT_INDENT_2)
+            .decode()
+            .replace("\n  ", "\n    ")
+        )
     return json.dumps(
         d,
         indent=4,
@@ -161,58 +230,84 @@ if __name__ == "__main__":
     arg_parser = create_script_arg_parser()
     parsed_args = arg_parser.parse_args(sys.argv[1:])
     buildlog_data = read_buildlog_file(parsed_args.buildlog_file_path)
-    tag_state = build_tag_state(buildlog_data)
-    print(pretty_printable_dict(tag_state))
+    digests, statuses = build_tag_state(buildlog_data)
+    # only sorted for display, the dicts derived from it below keep this order
+    digests = semver_sorted_dict(digests)
+    print(pretty_printable_dict(digests))
     # tag and push everything that doesn't need a manifest
     image_name = parsed_args.buildlog_file_path.stem
-    for key, value in tag_state.items():
-        if value["digest"] is not NEEDS_MANIFEST:
-            # Errors will show up here where containers/versions have been removed either because of our retention
-            # policy or ones that were yanked.
-            image_name_by_digest = (
-                f"gcr.io/ironcore-images/{image_name}@sha256:{value['digest']}"
-            )
-            pull = subprocess.run(["docker", "image", "pull", image_name_by_digest])
-            # tag with the new value
-            if pull.returncode == 0:
-                tag = subprocess.run(
-                    [
-                        "docker",
-                        "image",
-                        "tag",
-                        image_name_by_digest,
-                        f"gcr.io/ironcore-images/{image_name}:{key}",
-                    ]
-                )
-                if tag.returncode == 0:
-                    push = subprocess.run(
-                        ["docker", "push", f"gcr.io/ironcore-images/{image_name}:{key}"]
-                    )
-                    if push.returncode == 0:
-                        value["status"] = SUCCESS
-                        continue
-            value["status"] = FAILED
+    image_prefix = f"gcr.io/ironcore-images/{image_name}"
+    # group tags by digest so each image is only pulled once
+    tags_by_digest = {}
+    for key, digest in digests.items():
+        if digest != NEEDS_MANIFEST:
+            tags_by_digest.setdefault(digest, []).append(key)
+    # pulls and pushes are independent network bound work, so let docker run several at once
+    with ThreadPoolExecutor(max_workers=MAX_DOCKER_WORKERS) as executor:
+        # leaving the with block waits on everything queued, so cancel it first or Ctrl+C won't stop the pushes
+        try:
+            pulls = {
+                executor.submit(pull_image, image_prefix + "@sha256:" + digest): digest
+                for digest in tags_by_digest
+            }
+            pushes = {}
+            for pull in as_completed(pulls):
+                digest = pulls[pull]
+                # Errors will show up here where containers/versions have been removed either because of our retention
+                # policy or ones that were yanked.
+                if pull.result():
+                    image_name_by_digest = image_prefix + "@sha256:" + digest
+                    for key in tags_by_digest[digest]:
+                        push = executor.submit(
+                            tag_and_push_image,
+                            image_name_by_digest,
+                            image_prefix + ":" + key,
+                        )
+                        pushes[push] = key
+                else:
+                    for key in tags_by_digest[digest]:
+                        statuses[key] = FAILED
+            for push in as_completed(pushes):
+                statuses[pushes[push]] = SUCCESS if push.result() else FAILED
+        except (KeyboardInterrupt, SystemExit):
+            interrupted.set()
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
     # print what was tagged
-    successfully_tagged = {
-        k: v["digest"] for k, v in tag_state.items() if v["status"] is SUCCESS
-    }
-    failed_tags = {
-        k: v["digest"] for k, v in tag_state.items() if v["status"] is FAILED
-    }
-    needs_manifest = {
-        k: v["digest"] for k, v in tag_state.items() if v["digest"] is NEEDS_MANIFEST
-    }
+    successfully_tagged, failed_tags, needs_manifest = {}, {}, {}
+    for key, digest in digests.items():
+        if digest == NEEDS_MANIFEST:
+            needs_manifest[key] = digest
+        elif statuses[key] == SUCCESS:
+            successfully_tagged[key] = digest
+        elif statuses[key] == FAILED:
+            failed_tags[key] = digest
     print(pretty_printable_dict(successfully_tagged))
     print_error(pretty_printable_dict(failed_tags))
     print(pretty_printable_dict(needs_manifest))
     # use the tags just pushed to create manifests
     link_manifest = {}
+    # rebuilds aren't a factor now, so the newest patch under each major/minor is the one those tags should point at
+    patches_by_minor = {}
+    for key in needs_manifest:
+        major, minor, patch = (*key.split("."), None, None)[:3]
+        if patch:
+            patches_by_minor.setdefault((major, minor), []).append(key)
+    latest_patch_for = {}
+    for (major, minor), patches in patches_by_minor.items():
+        latest_patch = max(patches, key=_loose)
+        latest_patch_for[f"{major}.{minor}"] = latest_patch
+        if major not in latest_patch_for or _loose(latest_patch) > _loose(
+            latest_patch_for[major]
+        ):
+            latest_patch_for[major] = latest_patch
     for key in needs_manifest:
         # we expect no arch tags at this point
-        major, minor, patch = pad_none(key.split("."), 3)
+        major, minor, patch = (*key.split("."), None, None)[:3]
         # if there's a patch we need to create a manifest for it
         if patch:
-            gcr_image = f"gcr.io/ironcore-images/{image_name}:{key}"
+            gcr_image = image_prefix + ":" + key
+            arch_images = {arch: gcr_image + "-" + arch for arch in ("arm64", "amd64")}
             # all our images that need manifests have arm64/amd64 versions
             create_manifest = subprocess.run(
                 [
@@ -220,80 +315,51 @@ if __name__ == "__main__":
                     "manifest",
                     "create",
                     gcr_image,
-                    f"{gcr_image}-arm64",
-                    f"{gcr_image}-amd64",
+                    *arch_images.values(),
                 ]
             )
             if create_manifest.returncode == 0:
-                annotate_manifest_arm = subprocess.run(
-                    [
-                        "docker",
-                        "manifest",
-                        "annotate",
-                        gcr_image,
-                        f"{gcr_image}-arm64",
-                        "--arch",
-                        "arm64",
-                    ]
-                )
-                annotate_manifest_amd = subprocess.run(
-                    [
-                        "docker",
-                        "manifest",
-                        "annotate",
-                        gcr_image,
-                        f"{gcr_image}-amd64",
-                        "--arch",
-                        "amd64",
-                    ]
-                )
-                # if creation and annotation worked, push the new manifest
-                if (
-                    annotate_manifest_arm.returncode == 0
-                    and annotate_manifest_amd.returncode == 0
-                ):
-                    # rebuilds aren't a factor now and the tags are semver sorted, so the last writer is the right one
-                    major_manifest_name = f"gcr.io/ironcore-images/{image_name}:{major}"
-                    minor_manifest_name = (
-                        f"gcr.io/ironcore-images/{image_name}:{major}.{minor}"
-                    )
-                    # you can't create a manifest to move it if you've already created it locally without amending
-                    # unfortunately if you _do_ amend it just adds the new images to the mafest list instead of moving the tag.
-                    # we try to get around this by purging on push so each create is "new"
-                    # TODO: this isn't currently working, so major/minors need to be manually checked and moved afterwards
-                    subprocess.run(
-                        [
-                            "docker",
-                            "manifest",
-                            "create",
-                            "--amend",
-                            major_manifest_name,
-                            f"{gcr_image}-arm64",
-                            f"{gcr_image}-amd64",
-                        ]
-                    )
-                    subprocess.run(
+                # each annotation only touches its own image's entry in the local manifest list, so run them together
+                annotate_manifests = [
+                    subprocess.Popen(
                         [
                             "docker",
                             "manifest",
-                            "create",
-                            "--amend",
-                            minor_manifest_name,
-                            f"{gcr_image}-arm64",
-                            f"{gcr_image}-amd64",
+                            "annotate",
+                            gcr_image,
+                            arch_image,
+                            "--arch",
+                            arch,
                         ]
                     )
-                    # the more specific annotation of the first manifest seems to carry through to the others
-                    subprocess.run(["docker", "manifest", "push", "--purge", gcr_image])
-                    subprocess.run(
-                        ["docker", "manifest", "push", "--purge", major_manifest_name]
+                    for arch, arch_image in arch_images.items()
+                ]
+                # if creation and annotation worked, push the new manifest. A list rather than a generator so every
+                # annotation is waited on even if one fails.
+                if all([annotate.wait() == 0 for annotate in annotate_manifests]):
+                    push_manifest = subprocess.run(
+                        ["docker", "manifest", "push", "--purge", gcr_image]
                     )
-                    subprocess.run(
-                        [
-                            "docker",
-                            "manifest",
-                            "push",
-                            "--purge",
-                            minor_manifest_name,
+                    if push_manifest.returncode == 0:
+                        # point the major/minor tags at the manifest list we just pushed. Copying it in the registry
+                        # moves the tag outright, where `docker manifest create --amend` would add images to the
+                        # existing list, and it reuses the annotations instead of redoing them per tag.
+                        copy_manifests = [
+                            subprocess.Popen(
+                                [
+                                    "docker",
+                                    "buildx",
+                                    "imagetools",
+                                    "create",
+                                    "--tag",
+                                    image_prefix + ":" + floating_tag,
+                                    gcr_image,
+                                ]
+                            )
+                            for floating_tag in (major, f"{major}.{minor}")
+                            # floating tags that point straight at an image digest were already pushed above
+                            if floating_tag in needs_manifest
+                            and latest_patch_for[floating_tag] == key
                         ]
-                    )
+                        for copy_manifest in copy_manifests:
+                            copy_manifest.wait()